@@ -14,11 +14,15 @@ Features:
 - Defines spectral bands and their properties
 
 Requirements:
-- Python 3.6+
-- geopandas
+- Python 3.8+
+- geopandas 0.12+
+- pyogrio
 - pandas
 - rasterio
-- shapely
+- numpy
+- orjson
+- shapely 2.0+
+- pyarrow (optional, caches the image metadata CSV as Parquet)
 
 Usage:
     python tree-d_ann_creation.py shapefile_path image_folder output_json \
@@ -38,21 +42,112 @@ Learn more at https://treefund.org/
 """
 
 import os
-import json
 import argparse
-import glob
+import csv
+import importlib.util
+import time
 from datetime import datetime
 from pathlib import Path
 import geopandas as gpd
+import numpy as np
+import orjson
 import pandas as pd
 import rasterio
-from shapely.geometry import Polygon, mapping
+import shapely
+
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+BAND_NAMES = frozenset(["blue", "green", "red", "redEdge", "nir", *[f"band_{i}" for i in range(1, 20)]])
 
 def print_status(message, message_type="INFO"):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{timestamp}] [{message_type}] {message}")
 
 
+def band_name_for_key(key):
+    # Returns the band a metadata key describes, e.g. "red" for "red_wavelength"
+    # or "band_3" for "band_3_bandwidth", or None for non-band keys.
+    band_name, sep, attribute = key.rpartition('_')
+    if sep and attribute in ("wavelength", "bandwidth") and band_name in BAND_NAMES:
+        return band_name
+    
+    prefix, sep, _ = key.partition('_')
+    if sep and prefix in BAND_NAMES:
+        return prefix
+    
+    return None
+
+
+def ring_bbox_area(coords, starts, counts):
+    # Per-ring [x, y, width, height] and shoelace area for closed, non-empty
+    # rings stored back to back in coords.
+    mins = np.minimum.reduceat(coords, starts, axis=0)
+    maxs = np.maximum.reduceat(coords, starts, axis=0)
+    bboxes = np.column_stack([mins, maxs - mins])
+    
+    x, y = coords[:, 0], coords[:, 1]
+    cross = np.zeros(len(coords))
+    cross[:-1] = x[:-1] * y[1:] - x[1:] * y[:-1]
+    cross[starts + counts - 1] = 0.0
+    areas = 0.5 * np.abs(np.add.reduceat(cross, starts))
+    
+    return bboxes, areas
+
+
+def read_csv_cached(csv_path):
+    # Loads a CSV through a <name>.csv.parquet sidecar next to it. The sidecar
+    # records the CSV's mtime and size and is only reused when both match.
+    # Without pyarrow this is just pd.read_csv.
+    if not PARQUET_AVAILABLE:
+        return pd.read_csv(csv_path)
+    
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    parquet_path = Path(f"{csv_path}.parquet")
+    csv_stat = os.stat(csv_path)
+    source_metadata = {
+        b"tree_d_source_mtime_ns": str(csv_stat.st_mtime_ns).encode(),
+        b"tree_d_source_size": str(csv_stat.st_size).encode()
+    }
+    
+    if parquet_path.exists():
+        try:
+            cached_metadata = pq.read_schema(parquet_path).metadata or {}
+            if all(cached_metadata.get(key) == value for key, value in source_metadata.items()):
+                return pq.read_table(parquet_path).to_pandas()
+        except Exception as e:
+            print_status(f"Could not read cached {parquet_path}, reading CSV instead: {e}", "WARNING")
+    
+    df = pd.read_csv(csv_path)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **source_metadata})
+        pq.write_table(table, parquet_path)
+    except Exception as e:
+        print_status(f"Could not cache {csv_path} as Parquet: {e}", "WARNING")
+    
+    return df
+
+
+def write_annotations_json(output_json_path, json_data, annotations):
+    # Writes json_data with OPT_INDENT_2 layout, then streams each annotation
+    # into the trailing "annotations" array so they never sit in one list.
+    header = orjson.dumps(json_data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+    annotation_count = 0
+    
+    with open(output_json_path, 'wb') as f:
+        f.write(header[:-2])
+        f.write(b',\n  "annotations": [')
+        for annotation in annotations:
+            f.write(b',\n    ' if annotation_count else b'\n    ')
+            f.write(orjson.dumps(annotation, option=orjson.OPT_SERIALIZE_NUMPY))
+            annotation_count += 1
+        f.write(b'\n  ]\n}' if annotation_count else b']\n}')
+    
+    return annotation_count
+
+
 def process_image(img_path, image_id, image_metadata=None):
     file_name = os.path.basename(img_path)
     
@@ -60,7 +155,8 @@ def process_image(img_path, image_id, image_metadata=None):
         with rasterio.open(img_path) as src:
             width = src.width
             height = src.height
-            resolution = src.transform[0]
+            transform = src.transform
+            resolution = transform[0]
             count = src.count
         
         image = {
@@ -82,7 +178,7 @@ def process_image(img_path, image_id, image_metadata=None):
         
         if not image_metadata or file_name not in image_metadata:
             print_status(f"Required metadata missing for image: {file_name}", "ERROR")
-            return None
+            return None, None
         
         meta = image_metadata[file_name]
         
@@ -90,7 +186,7 @@ def process_image(img_path, image_id, image_metadata=None):
         for field in required_fields:
             if field not in meta:
                 print_status(f"Required field '{field}' missing from metadata for {file_name}", "ERROR")
-                return None
+                return None, None
         
         try:
             date_obj = datetime.strptime(meta["date_captured"], "%Y-%m-%d")
@@ -98,13 +194,13 @@ def process_image(img_path, image_id, image_metadata=None):
             image["julian_day"] = str(date_obj.timetuple().tm_yday)
         except ValueError as e:
             print_status(f"Invalid date format in metadata for {file_name}. Expected YYYY-MM-DD", "ERROR")
-            return None
+            return None, None
         
         for key, value in meta.items():
             if key == 'file_name':
                 continue
             
-            if '_' in key and key.split('_')[0] in ["blue", "green", "red", "redEdge", "nir"] + [f"band_{i}" for i in range(1, 20)]:
+            if band_name_for_key(key):
                 continue
             else:
                 image[key] = value
@@ -131,16 +227,19 @@ def process_image(img_path, image_id, image_metadata=None):
         elif image_type == "multispectral":
             available_bands = set()
             for key in meta.keys():
-                if '_' in key:
-                    band_name = key.split('_')[0]
-                    if band_name in ["blue", "green", "red", "redEdge", "nir"] or band_name.startswith("band_"):
-                        available_bands.add(band_name)
+                band_name = band_name_for_key(key)
+                if band_name:
+                    available_bands.add(band_name)
             
             if not available_bands:
                 print_status(f"No band information found for multispectral image {file_name}", "ERROR")
-                return None
+                return None, None
             
-            for i, band_name in enumerate(sorted(available_bands)):
+            band_order = sorted(
+                available_bands,
+                key=lambda name: (name.startswith("band_"), int(name[5:]) if name.startswith("band_") else 0, name)
+            )
+            for i, band_name in enumerate(band_order):
                 wavelength = meta.get(f"{band_name}_wavelength")
                 bandwidth = meta.get(f"{band_name}_bandwidth")
                 
@@ -156,16 +255,16 @@ def process_image(img_path, image_id, image_metadata=None):
             
             if not image["spectral_bands"]:
                 print_status(f"No valid bands found for multispectral image {file_name}", "ERROR")
-                return None
+                return None, None
         else:
             print_status(f"Unknown image type '{image_type}' for {file_name}. Must be 'RGB' or 'Multispectral'.", "ERROR")
-            return None
+            return None, None
         
-        return image
+        return image, transform
         
     except Exception as e:
         print_status(f"Error reading {img_path}: {e}", "ERROR")
-        return None
+        return None, None
 
 
 def shapefile_to_json_annotations(
@@ -196,8 +295,7 @@ def shapefile_to_json_annotations(
             }
         ],
         "categories": [],
-        "images": [],
-        "annotations": []
+        "images": []
     }
     
     if dataset_info:
@@ -208,30 +306,31 @@ def shapefile_to_json_annotations(
             print_status(f"Taxonomy CSV not found: {taxonomy_csv}", "ERROR")
             return False
             
-        df_taxonomy = pd.read_csv(taxonomy_csv)
-        print_status(f"Loaded taxonomy data with {len(df_taxonomy)} species")
+        with open(taxonomy_csv, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            taxonomy_columns = reader.fieldnames or []
+            taxonomy_rows = list(reader)
+        print_status(f"Loaded taxonomy data with {len(taxonomy_rows)} species")
         
         required_columns = ["id", "family"]
-        missing_columns = [col for col in required_columns if col not in df_taxonomy.columns]
+        missing_columns = [col for col in required_columns if col not in taxonomy_columns]
         if missing_columns:
             print_status(f"Taxonomy CSV missing required columns: {missing_columns}", "ERROR")
             return False
         
-        if "genus" not in df_taxonomy.columns:
+        if "genus" not in taxonomy_columns:
             print_status("No genus column found in taxonomy CSV. Adding 'Unspecified' as default genus.", "WARNING")
-            df_taxonomy["genus"] = "Unspecified"
         
-        if "species" not in df_taxonomy.columns:
+        if "species" not in taxonomy_columns:
             print_status("No species column found in taxonomy CSV. Adding 'sp.' as default species.", "WARNING")
-            df_taxonomy["species"] = "sp."
         
         species_id_map = {}
         
-        for _, row in df_taxonomy.iterrows():
-            species_id = row["id"]
+        for row in taxonomy_rows:
+            species_id = int(row["id"])
             family = row["family"]
-            genus = row["genus"]
-            species = row["species"]
+            genus = row.get("genus", "Unspecified")
+            species = row.get("species", "sp.")
             
             if not family:
                 print_status(f"Missing family for taxonomy ID {species_id}. Family is required.", "ERROR")
@@ -268,28 +367,38 @@ def shapefile_to_json_annotations(
             print_status(f"Image metadata CSV not found: {image_metadata_csv}", "ERROR")
             return False
             
-        df_image_meta = pd.read_csv(image_metadata_csv)
+        df_image_meta = read_csv_cached(image_metadata_csv)
         print_status(f"Loaded image metadata with {len(df_image_meta)} entries")
         
         if "file_name" not in df_image_meta.columns:
             print_status("Image metadata CSV must contain a 'file_name' column", "ERROR")
             return False
         
-        image_metadata = {}
-        for _, row in df_image_meta.iterrows():
-            file_name = row["file_name"]
-            image_metadata[file_name] = row.to_dict()
+        image_metadata = (
+            df_image_meta.drop_duplicates("file_name", keep="last")
+            .set_index("file_name", drop=False)
+            .to_dict("index")
+        )
             
     except Exception as e:
         print_status(f"Error processing image metadata CSV: {e}", "ERROR")
         return False
     
+    image_extensions = ['.tif', '.tiff', '.jpg', '.jpeg', '.png']
     ortho_image_path = None
-    for ext in ['.tif', '.tiff', '.jpg', '.jpeg', '.png']:
-        matches = glob.glob(os.path.join(image_folder, f'*{ext}'))
-        if matches:
-            ortho_image_path = matches[0]
-            break
+    best_rank = len(image_extensions)
+    try:
+        with os.scandir(image_folder) as entries:
+            for entry in entries:
+                ext = os.path.splitext(entry.name)[1].lower()
+                if ext in image_extensions and not entry.name.startswith('.') and entry.is_file():
+                    rank = image_extensions.index(ext)
+                    if rank < best_rank:
+                        ortho_image_path = entry.path
+                        best_rank = rank
+    except OSError as e:
+        print_status(f"Error reading image folder {image_folder}: {e}", "ERROR")
+        return False
     
     if not ortho_image_path:
         print_status(f"No image found in {image_folder}", "ERROR")
@@ -299,7 +408,7 @@ def shapefile_to_json_annotations(
     print_status(f"Found image: {ortho_image_name}")
     
     image_id = 1
-    image = process_image(ortho_image_path, image_id, image_metadata)
+    image, transform = process_image(ortho_image_path, image_id, image_metadata)
     
     if not image:
         print_status(f"Error processing image", "ERROR")
@@ -310,7 +419,7 @@ def shapefile_to_json_annotations(
     
     try:
         print_status(f"Reading shapefile: {shapefile_path}")
-        gdf = gpd.read_file(shapefile_path)
+        gdf = gpd.read_file(shapefile_path, engine="pyogrio", columns=["species_id"])
         print_status(f"Loaded shapefile with {len(gdf)} features")
         
         required_columns = ["species_id"]
@@ -325,77 +434,63 @@ def shapefile_to_json_annotations(
     
     print_status("Processing annotations for image")
     
+    is_polygon = (gdf.geometry.geom_type == "Polygon").to_numpy()
+    is_empty = shapely.is_empty(gdf.geometry.to_numpy())
+    known_species = gdf['species_id'].isin(list(species_id_map)).to_numpy()
+    
+    unknown_mask = is_polygon & ~is_empty & ~known_species
+    skip_reasons = {
+        "non-polygon geometry": int((~is_polygon).sum()),
+        "empty polygon": int((is_polygon & is_empty).sum()),
+        "species ID not in taxonomy": int(unknown_mask.sum())
+    }
+    
+    if unknown_mask.any():
+        unknown_ids = gdf.loc[unknown_mask, 'species_id'].unique().tolist()
+        print_status(f"Species IDs not found in taxonomy mapping: {unknown_ids}", "WARNING")
+    
+    valid_mask = is_polygon & ~is_empty & known_species
+    gdf = gdf.loc[valid_mask].reset_index(drop=True)
+    
+    inv = ~transform
+    inv_matrix = np.array([[inv.a, inv.b], [inv.d, inv.e]])
+    inv_offset = np.array([inv.xoff, inv.yoff])
+    
     try:
-        with rasterio.open(ortho_image_path) as src:
-            transform = src.transform
+        geoms = gdf.geometry.to_numpy()
+        ring_coords, ring_index = shapely.get_coordinates(
+            shapely.get_exterior_ring(geoms), return_index=True
+        )
+        pixel_coords = ring_coords @ inv_matrix.T + inv_offset
+        ring_counts = np.bincount(ring_index, minlength=len(geoms))
+        ring_starts = np.cumsum(ring_counts) - ring_counts
+        pixel_rings = np.split(pixel_coords, ring_starts[1:])
+        pixel_bboxes, pixel_areas = ring_bbox_area(pixel_coords, ring_starts, ring_counts)
     except Exception as e:
-        print_status(f"Error opening image: {e}", "ERROR")
+        print_status(f"Error converting coordinates to pixel space: {e}", "ERROR")
         return False
     
-    annotation_id = 1
-    skipped_count = 0
+    species_ids = gdf['species_id'].to_numpy()
     
-    for idx, row in gdf.iterrows():
-        geom = row.geometry
-        
-        if not isinstance(geom, Polygon):
-            print_status(f"Skipping non-polygon geometry at index {idx}", "WARNING")
-            skipped_count += 1
-            continue
-        
-        species_id = row.get('species_id')
-        if species_id in species_id_map:
-            category_id = species_id_map[species_id]
-        else:
-            print_status(f"Species ID {species_id} not found in taxonomy mapping. Skipping.", "WARNING")
-            skipped_count += 1
-            continue
-            
-        try:
-            geo_coords = list(geom.exterior.coords)
-            pixel_coords = []
-            
-            for x, y in geo_coords:
-                px, py = ~transform * (x, y)
-                pixel_coords.append((px, py))
-            
-            from shapely.geometry import Polygon as ShapelyPolygon
-            pixel_poly = ShapelyPolygon(pixel_coords)
-            
-            coords = list(pixel_poly.exterior.coords)
-            flat_coords = []
-            for coord in coords:
-                flat_coords.extend([coord[0], coord[1]])
-            segmentation = [flat_coords]
-            
-            minx, miny, maxx, maxy = pixel_poly.bounds
-            bbox = [minx, miny, maxx - minx, maxy - miny]
-            
-            area = pixel_poly.area
-            
-        except Exception as e:
-            print_status(f"Error converting coordinates for polygon at index {idx}: {e}", "WARNING")
-            skipped_count += 1
-            continue
-        
-        annotation = {
-            "id": annotation_id,
-            "image_id": image_id,
-            "category_id": category_id,
-            "segmentation": segmentation,
-            "area": area,
-            "bbox": bbox,
-            "iscrowd": 0
-        }
-        
-        json_data["annotations"].append(annotation)
-        annotation_id += 1
+    def iter_annotations():
+        for idx, species_id in enumerate(species_ids):
+            yield {
+                "id": idx + 1,
+                "image_id": image_id,
+                "category_id": species_id_map[species_id],
+                "segmentation": [pixel_rings[idx].ravel().tolist()],
+                "area": pixel_areas[idx],
+                "bbox": pixel_bboxes[idx].tolist(),
+                "iscrowd": 0
+            }
     
-    with open(output_json_path, 'w') as f:
-        json.dump(json_data, f, indent=2)
+    annotation_count = write_annotations_json(output_json_path, json_data, iter_annotations())
     
-    print_status(f"Converted {len(json_data['annotations'])} annotations to {output_json_path}")
-    print_status(f"Skipped {skipped_count} features")
+    print_status(f"Converted {annotation_count} annotations to {output_json_path}")
+    print_status(f"Skipped {sum(skip_reasons.values())} features")
+    for reason, count in skip_reasons.items():
+        if count:
+            print_status(f"  {reason}: {count}", "WARNING")
     print_status(f"Dataset includes 1 image and {len(json_data['categories'])} species")
     
     end_time = datetime.now()